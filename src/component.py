@@ -2,10 +2,15 @@
 Template Component main class.
 
 """
+import csv
 import logging
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from functools import lru_cache
-from typing import List, Dict
+from operator import itemgetter
+from typing import List, Dict, Iterator, Iterable, Optional, Union, Sequence
 
 import urllib3
 from keboola.component.base import ComponentBase
@@ -17,7 +22,16 @@ from requests.exceptions import RequestException
 
 from filemaker.client import DataApiClient, ClientUserError
 
+# suppress ssl warnings and rather log once
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
 TIMESTAMP_FORMAT = '%m/%d/%Y %H:%M:%S'
+# output file buffer, collapses the per-row write calls into few large writes
+WRITER_BUFFER_SIZE = 8 * 1024 * 1024
+# number of data pages downloaded ahead while the current one is being written
+PREFETCH_DEPTH = 2
+# max number of concurrent metadata requests
+MAX_METADATA_WORKERS = 8
 
 KEY_PASSWORD = '#password'
 KEY_USERNAME = 'username'
@@ -35,14 +49,160 @@ REQUIRED_PARAMETERS = [KEY_PASSWORD, KEY_USERNAME, KEY_DATABASE, KEY_BASEURL]
 REQUIRED_IMAGE_PARS = []
 
 
+class _NewlineTranslatingFile:
+    """
+    Converts the \\r\\n and \\r line breaks of the written lines to \\n, the same way the ElasticDictWriter does
+    when it reads its temporary files back, so the result files of both writers are byte identical.
+    """
+
+    def __init__(self, file):
+        self._write = file.write
+
+    def write(self, line: str) -> int:
+        return self._write(line.replace('\r\n', '\n').replace('\r', '\n'))
+
+
+class SchemaDictWriter:
+    """
+    Append-only writer for tables with a known header, e.g. stored from the previous run or taken from the first
+    data page. Rows are written directly to the result file as value lists in the header order, without the per-row
+    header checks and the final merge pass of the ElasticDictWriter.
+
+    If a row with an unknown column arrives (the layout has changed), the rows written so far are handed over
+    to an ElasticDictWriter, which then extends the header as usual.
+
+    NOTE: close() method must be called at the end of processing to get the result.
+    """
+
+    def __init__(self, file_path: str, fieldnames: List[str], buffering: int = WRITER_BUFFER_SIZE):
+        self.result_path = file_path
+        self._fieldnames = list(fieldnames)
+        self._fieldnames_set = set(self._fieldnames)
+        self._columns = tuple(self._fieldnames)
+        # C level extraction of all values as a tuple, itemgetter of a single item would not return a tuple
+        self._get_all_values = itemgetter(*self._columns) if len(self._columns) > 1 else None
+        self._buffering = buffering
+        self._file = open(file_path, 'w', newline='', encoding='utf-8', buffering=buffering)
+        # default dialect, values containing CR or LF are quoted
+        self._writer = csv.writer(_NewlineTranslatingFile(self._file))
+        self._elastic_writer: Optional[ElasticDictWriter] = None
+        self._unknown_row: Optional[dict] = None
+
+    @property
+    def fieldnames(self) -> List[str]:
+        if self._elastic_writer:
+            return self._elastic_writer.fieldnames
+        return self._fieldnames
+
+    def writerow(self, row: dict):
+        self.writerows((row,))
+
+    def writerows(self, rows: Iterable[dict]):
+        rows = iter(rows)
+        if not self._elastic_writer:
+            # all rows in a single call of the C writer, stops at the first row with an unknown column
+            self._writer.writerows(self._known_rows_values(rows))
+            if self._unknown_row is None:
+                return
+            self._switch_to_elastic_writer()
+            self._elastic_writer.writerow(self._unknown_row)
+            self._unknown_row = None
+        self._elastic_writer.writerows(rows)
+
+    def _known_rows_values(self, rows: Iterator[dict]) -> Iterator[Sequence]:
+        columns = self._columns
+        column_count = len(columns)
+        known_columns = self._fieldnames_set
+        get_all_values = self._get_all_values
+        for row in rows:
+            if not row.keys() <= known_columns:
+                self._unknown_row = row
+                return
+            if get_all_values and len(row) == column_count:
+                # all columns present, typical for FileMaker records
+                yield get_all_values(row)
+            else:
+                yield [row.get(c, '') for c in columns]
+
+    def _switch_to_elastic_writer(self):
+        logging.debug(f'New columns found in {self.result_path}, extending the known header.')
+        self._file.close()
+        elastic_writer = ElasticDictWriter(self.result_path, list(self._fieldnames), buffering=self._buffering)
+        # the ElasticDictWriter produces the result file on close, so it is safe to read it back first
+        with open(self.result_path, 'r', newline='', encoding='utf-8') as written_file:
+            elastic_writer.writerows(csv.DictReader(written_file, fieldnames=self._fieldnames))
+        self._elastic_writer = elastic_writer
+
+    def close(self):
+        if self._elastic_writer:
+            self._elastic_writer.close()
+        else:
+            self._file.close()
+
+
 @dataclass
 class WriterCacheEntry:
-    writer: ElasticDictWriter
+    writer: Union[SchemaDictWriter, ElasticDictWriter]
     table_definition: TableDefinition
 
 
+_PREFETCH_END = object()
+
+
+def prefetch(iterator: Iterator, depth: int = PREFETCH_DEPTH) -> Iterator:
+    """
+    Consumes the iterator in a background thread so the next items are fetched while the current one is processed.
+    Exceptions raised by the iterator are re-raised in the consuming thread.
+    Args:
+        iterator: source iterator, e.g. the paged API response
+        depth: maximum number of items fetched ahead
+
+    Returns: Iterator yielding the same items in the same order.
+
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def _put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+            _put((_PREFETCH_END, None))
+        except Exception as e:
+            _put((_PREFETCH_END, e))
+        finally:
+            # finalize the source generator in the thread that runs it, e.g. when the consumer stopped early
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+    worker = threading.Thread(target=_produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error:
+                raise error
+            if item is _PREFETCH_END:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
 class HeaderNormalizer:
     UNDERSCORE_PREFIX = 'hsh'
+    NORMALIZED_PREFIX = f'{UNDERSCORE_PREFIX}_'
 
     @staticmethod
     def reconstruct_original_columns(column_names: List[str]) -> List[str]:
@@ -54,14 +214,10 @@ class HeaderNormalizer:
         Returns:
 
         """
-        new_header = []
-        for c in column_names:
-            if c.startswith(f'{HeaderNormalizer.UNDERSCORE_PREFIX}_'):
-                new_col = c.replace(f'{HeaderNormalizer.UNDERSCORE_PREFIX}_', '_')
-            else:
-                new_col = c
-            new_header.append(new_col)
-        return new_header
+        prefix = HeaderNormalizer.NORMALIZED_PREFIX
+        prefix_len = len(HeaderNormalizer.UNDERSCORE_PREFIX)
+        # strip only the leading prefix, keep the underscore
+        return [c[prefix_len:] if c.startswith(prefix) else c for c in column_names]
 
     @staticmethod
     def normalize_columns(column_names: List[str]) -> List[str]:
@@ -73,14 +229,8 @@ class HeaderNormalizer:
         Returns:
 
         """
-        new_header = []
-        for c in column_names:
-            if c.startswith('_'):
-                new_col = f'{HeaderNormalizer.UNDERSCORE_PREFIX}{c}'
-            else:
-                new_col = c
-            new_header.append(new_col)
-        return new_header
+        prefix = HeaderNormalizer.UNDERSCORE_PREFIX
+        return [f'{prefix}{c}' if c.startswith('_') else c for c in column_names]
 
 
 class Component(ComponentBase):
@@ -101,17 +251,20 @@ class Component(ComponentBase):
                                      self.configuration.parameters[KEY_USERNAME],
                                      self.configuration.parameters[KEY_PASSWORD],
                                      ssl_verify=self.configuration.parameters.get('ssl_verify', True))
-        state = self.get_state_file() or {}
-        self._layout_schemas: dict = state.get('table_schemas') or {}
+        self._current_state: dict = self.get_state_file() or {}
+        self._layout_schemas: dict = self._current_state.get('table_schemas') or {}
         self._writer_cache: Dict[str, WriterCacheEntry] = {}
-        self._current_state = state.copy()
+        self._table_definitions: Dict[str, TableDefinition] = {}
+
+        # output table options are the same for all layout tables
+        loading_options = self.configuration.parameters.get('loading_options', {})
+        self._primary_key = HeaderNormalizer.normalize_columns(loading_options.get('pkey', []))
+        self._incremental = loading_options.get('incremental', False)
 
         if not self._current_state.get('previous_run_values'):
             self._current_state['previous_run_values'] = {}
 
         self.validate_configuration_parameters(REQUIRED_PARAMETERS)
-        # suppress ssl warnings and rather log once
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     def run(self):
         """
@@ -125,19 +278,22 @@ class Component(ComponentBase):
         if not params.get('ssl_verify', True):
             logging.warning("SSL certificate verification is disabled!")
 
-        if params.get('object_type', 'Layout') == 'Metadata':
-            self._download_metadata()
-        elif params.get('object_type', 'Layout') == 'Layout':
-            self._init_state()
-            self.validate_configuration_parameters(REQUIRED_PARAMETERS + [KEY_LAYOUT_NAME])
-            self._download_layout_data()
+        try:
+            if params.get('object_type', 'Layout') == 'Metadata':
+                self._download_metadata()
+            elif params.get('object_type', 'Layout') == 'Layout':
+                self.validate_configuration_parameters(REQUIRED_PARAMETERS + [KEY_LAYOUT_NAME])
+                self._init_state()
+                self._download_layout_data()
 
-        else:
-            raise UserException(f"Invalid object type '{params['object_type']}'!")
+            else:
+                raise UserException(f"Invalid object type '{params['object_type']}'!")
+        finally:
+            # single logout per database session
+            self._client.close()
 
         result_tables = self._close_writers()
-        self._current_state['table_schemas'] = self._layout_schemas
-        self.write_state_file(self._current_state)
+        self.write_state_file({**self._current_state, 'table_schemas': self._layout_schemas})
         self.write_manifests(result_tables)
 
     def test_connection(self):
@@ -148,66 +304,54 @@ class Component(ComponentBase):
                                 f"please check your credentials. Detail: {e}") from e
 
     def _init_state(self):
-        if not self._current_state.get('previous_run_values'):
-            self._current_state['previous_run_values'][self.configuration.parameters[KEY_LAYOUT_NAME]] = {}
-        elif not self._current_state['previous_run_values'].get(self.configuration.parameters[KEY_LAYOUT_NAME]):
+        layout_name = self.configuration.parameters[KEY_LAYOUT_NAME]
+        previous_run_values = self._current_state['previous_run_values']
+        if not previous_run_values.get(layout_name):
             # fix kbc bug converting obj to array
-            self._current_state['previous_run_values'][self.configuration.parameters[KEY_LAYOUT_NAME]] = {}
+            previous_run_values[layout_name] = {}
+        # reference to the layout state, updated in place
+        self._layout_run_values: dict = previous_run_values[layout_name]
 
-    def _get_last_values(self, layout_name: str, field_names: List[str]) -> Dict:
+    def _get_last_values(self, field_names: List[str]) -> Dict:
         """
         Retrieves max incremental fetching value from previous execution for this layout
         Args:
-            layout_name:
-            field_name:
+            field_names:
 
         Returns:
 
         """
-        state = self.get_state_file()
-        prev_run_values = state.get('previous_run_values', {})
-        if not prev_run_values.get(layout_name, {}):
-            # fix kbc bug converting obj to array
-            prev_run_values[layout_name] = {}
-        last_values = {}
-        for field in field_names:
-            prev_value = prev_run_values.get(layout_name, {}).get(field)
-            if prev_value:
-                last_values[field] = prev_run_values.get(layout_name, {}).get(field)
-        return last_values
-
-    def _apply_incremental_fetching(self, layout_name: str, query_list: List[dict]):
+        layout_run_values = self._layout_run_values
+        return {field: layout_run_values[field] for field in field_names if layout_run_values.get(field)}
+
+    def _apply_incremental_fetching(self, query_list: List[dict], loading_options: dict):
         """
         Inplace, Applies incremental fetching filter if specified. Based on previous execution
+        Args:
+            query_list:
+            loading_options: loading_options configuration parameter
 
         Returns:
 
         """
-        field_names = self.configuration.parameters.get('loading_options', {}).get('incremental_fields', [])
-        incremental_fetching = self.configuration.parameters.get('loading_options', {}).get('incremental_fetch')
-        previous_values = self._get_last_values(layout_name, field_names)
-        query = {}
-        if incremental_fetching and previous_values:
-            for field_name, previous_value in previous_values.items():
-                query[field_name] = f'>= {previous_value}'
-            query_list.append(query)
+        field_names = loading_options.get('incremental_fields', [])
+        previous_values = self._get_last_values(field_names)
+        if loading_options.get('incremental_fetch') and previous_values:
+            query_list.append({field_name: f'>= {previous_value}'
+                               for field_name, previous_value in previous_values.items()})
 
         return field_names
 
-    def _build_sort_expression(self):
-        field_names = self.configuration.parameters.get('loading_options', {}).get('incremental_fields')
-        incremental_fetching = self.configuration.parameters.get('loading_options', {}).get('incremental_fetch')
-        sort = []
-        if incremental_fetching and field_names:
-            for field in field_names:
-                sort.append({'fieldName': field})
-        return sort
+    def _build_sort_expression(self, loading_options: dict):
+        field_names = loading_options.get('incremental_fields')
+        if loading_options.get('incremental_fetch') and field_names:
+            return [{'fieldName': field} for field in field_names]
+        return []
 
-    def _store_max_value(self, layout_name: str, row: dict, field_names: List[str]):
+    def _store_max_value(self, row: dict, field_names: List[str]):
         """
         Stores max timestamp value from the row based on previous call of this method.
         Args:
-            layout_name:
             row:
             field_names:
 
@@ -217,9 +361,12 @@ class Component(ComponentBase):
         if not field_names or not row:
             return
 
+        layout_run_values = self._layout_run_values
         for field_name in field_names:
-            current_value = row[field_name]
-            self._current_state['previous_run_values'][layout_name][field_name] = current_value
+            value = row.get(field_name)
+            # empty value would reset the incremental fetching, keep the previous one
+            if value:
+                layout_run_values[field_name] = value
 
     def _download_layout_data(self):
         """
@@ -227,19 +374,20 @@ class Component(ComponentBase):
         Returns:
 
         """
-        layout_name = self.configuration.parameters[KEY_LAYOUT_NAME]
-        database_name = self.configuration.parameters[KEY_DATABASE]
+        params = self.configuration.parameters
+        layout_name = params[KEY_LAYOUT_NAME]
+        database_name = params[KEY_DATABASE]
+        loading_options = params.get('loading_options', {})
+        pagination_limit = params.get('page_size', 1000)
 
         # build query
         query_list = self._build_queries()
-        fetching_fields = self._apply_incremental_fetching(layout_name, query_list)
+        fetching_fields = self._apply_incremental_fetching(query_list, loading_options)
 
-        sort_expression = self._build_sort_expression()
+        sort_expression = self._build_sort_expression(loading_options)
 
         logging.info(f'Fetching data for layout "{layout_name}", filter: {query_list}, sort: {sort_expression}')
 
-        pagination_limit = self.configuration.parameters.get('page_size', 1000)
-
         # when the query is empty, list records without filter
         if not query_list:
             response_iterator = self._client.get_records(database_name, layout_name, pagination_limit, sort_expression)
@@ -248,23 +396,25 @@ class Component(ComponentBase):
                                                           sort_expression)
         try:
             count = 1
-            last_row = dict()
-            for data_page, data_info in response_iterator:
+            last_page = []
+            # download next page while the current one is being written
+            for data_page, data_info in prefetch(response_iterator):
                 page_size = len(data_page)
                 logging.info(f'Downloading records {count} - {count + page_size}')
                 count += page_size
                 # this is cached, we do not know table name before first response. Datainfo is same in all parts
                 table_definition = self._build_table_definition(data_info['table'])
-                writer = self._get_writer_from_cache(table_definition, data_info['table'])
+                writer = self._get_writer_from_cache(table_definition, data_info['table'],
+                                                     sample_rows=(row['fieldData'] for row in data_page))
 
-                # select max timestamp value to reduce sorting load on FileMaker db.
-                for row in data_page:
-                    writer.writerow(row['fieldData'])
-                    if row['fieldData']:
-                        last_row = row['fieldData']
+                writer.writerows(row['fieldData'] for row in data_page)
+                if data_page:
+                    last_page = data_page
 
+            # records are sorted by the incremental fields, the last non-empty one holds the max value
+            last_row = next((row['fieldData'] for row in reversed(last_page) if row['fieldData']), {})
             logging.debug(last_row)
-            self._store_max_value(layout_name, last_row, fetching_fields)
+            self._store_max_value(last_row, fetching_fields)
 
         except RequestException as e:
             raise UserException(e) from e
@@ -279,17 +429,15 @@ class Component(ComponentBase):
 
         """
 
-        query_list = list()
+        query_groups = self.configuration.parameters[KEY_QUERY]
+        query_list = [{q[KEY_FIELD_NAME]: q[KEY_FIND_CRITERIA] for q in group} for group in query_groups]
 
         duplicate_keys = set()
-        for query_group in self.configuration.parameters[KEY_QUERY]:
-            single_query = {}
-            for q in query_group:
-                if q[KEY_FIELD_NAME] in single_query:
-                    duplicate_keys.add(q[KEY_FIELD_NAME])
-                single_query[q[KEY_FIELD_NAME]] = q[KEY_FIND_CRITERIA]
-            query_list.append(single_query)
-
+        for group, query in zip(query_groups, query_list):
+            # the group collapsed into a smaller dict, some field is listed more than once
+            if len(query) < len(group):
+                field_counts = Counter(q[KEY_FIELD_NAME] for q in group)
+                duplicate_keys.update(field_name for field_name, count in field_counts.items() if count > 1)
         if duplicate_keys:
             raise UserException(
                 f'Single key can be listed only once in a query group (AND)! Affected keys: {duplicate_keys} '
@@ -310,20 +458,26 @@ class Component(ComponentBase):
         database_names = self._client.get_database_names()
         layouts_writer = self._get_writer_from_cache(layouts_table, layouts_table.name)
 
-        for database in database_names:
-            layouts = self._client.get_layouts(database)
-            layouts_data = self._parse_layout_data(layouts, database)
-            layouts_writer.writerows(layouts_data)
-
         field_metadata_filter = self.configuration.parameters.get('field_metadata', [])
         layout_metadata_table = self.create_out_table_definition('layout_fields_metadata.csv', incremental=False)
         layout_metadata_writer = self._get_writer_from_cache(layout_metadata_table, layout_metadata_table.name)
-        if field_metadata_filter:
-            logging.info('Downloading available field schemas for specified layouts.')
-        for field_f in field_metadata_filter:
-            layout_metadata = self._client.get_layout_field_metadata(field_f['database'], field_f['layout_name'])
-            layout_metadata_writer.writerows(
-                self._parse_layout_metadata(layout_metadata, field_f['database'], field_f['layout_name']))
+
+        # all requests are submitted at once and run in parallel,
+        # results are written in the original order by this thread
+        with ThreadPoolExecutor(max_workers=MAX_METADATA_WORKERS) as executor:
+            layouts_results = executor.map(self._client.get_layouts, database_names)
+            layout_metadata_results = executor.map(self._client.get_layout_field_metadata,
+                                                   [field_f['database'] for field_f in field_metadata_filter],
+                                                   [field_f['layout_name'] for field_f in field_metadata_filter])
+
+            for database, layouts in zip(database_names, layouts_results):
+                layouts_writer.writerows(self._parse_layout_data(layouts, database))
+
+            if field_metadata_filter:
+                logging.info('Downloading available field schemas for specified layouts.')
+            for field_f, layout_metadata in zip(field_metadata_filter, layout_metadata_results):
+                layout_metadata_writer.writerows(
+                    self._parse_layout_metadata(layout_metadata, field_f['database'], field_f['layout_name']))
 
     def _parse_layout_metadata(self, layout_metadata: List[dict], database: str, layout_name: str):
         for record in layout_metadata:
@@ -331,38 +485,53 @@ class Component(ComponentBase):
             record['layout_name'] = layout_name
             yield record
 
-    def _parse_layout_data(self, layouts: List[dict], database: str) -> List[dict]:
-        layout_records = []
-
+    def _parse_layout_data(self, layouts: List[dict], database: str) -> Iterator[dict]:
         for lo in layouts:
             if lo.get('isFolder', False):
                 parent_layout_name = lo['name']
-                children = [
-                    {"database_name": database, "parent_layout_name": parent_layout_name, "layout_name": child['name'],
-                     "table": child.get('table', '')}
-                    for child in lo['folderLayoutNames']]
-                layout_records.extend(children)
+                for child in lo['folderLayoutNames']:
+                    yield {"database_name": database,
+                           "parent_layout_name": parent_layout_name,
+                           "layout_name": child['name'],
+                           "table": child.get('table', '')}
             else:
-                layout_records.append({"database_name": database,
-                                       "parent_layout_name": '',
-                                       "layout_name": lo["name"],
-                                       "table": lo['table']})
-        return layout_records
-
-    @lru_cache(10)
-    def _build_table_definition(self, table_name: str):
-        primary_key = self.configuration.parameters['loading_options'].get('pkey', [])
-        # normalize
-        primary_key = HeaderNormalizer.normalize_columns(primary_key)
-        incremental = self.configuration.parameters['loading_options'].get('incremental', False)
-        return self.create_out_table_definition(f'{table_name}.csv', primary_key=primary_key, incremental=incremental)
-
-    @lru_cache(10)
-    def _get_writer_from_cache(self, table_definition: TableDefinition, table_name: str) -> ElasticDictWriter:
+                yield {"database_name": database,
+                       "parent_layout_name": '',
+                       "layout_name": lo["name"],
+                       "table": lo['table']}
+
+    def _build_table_definition(self, table_name: str) -> TableDefinition:
+        table_definition = self._table_definitions.get(table_name)
+        if not table_definition:
+            table_definition = self.create_out_table_definition(f'{table_name}.csv', primary_key=self._primary_key,
+                                                                incremental=self._incremental)
+            self._table_definitions[table_name] = table_definition
+        return table_definition
+
+    def _get_writer_from_cache(self, table_definition: TableDefinition, table_name: str,
+                               sample_rows: Iterable[dict] = ()) -> Union[SchemaDictWriter, ElasticDictWriter]:
+        """
+        Returns cached writer of the table, creates a new one on first call.
+        Args:
+            table_definition:
+            table_name:
+            sample_rows: first rows of the data, their columns extend the header stored from the previous run.
+            Used only when the writer is created.
+
+        Returns:
+
+        """
 
         if not self._writer_cache.get(table_name):
             column_headers = HeaderNormalizer.reconstruct_original_columns(self._layout_schemas.get(table_name, []))
-            writer = ElasticDictWriter(table_definition.full_path, column_headers)
+            # FileMaker returns all layout fields in each record, the first page reveals the complete schema
+            known_columns = set(column_headers)
+            column_headers.extend(c for c in dict.fromkeys(c for row in sample_rows for c in row)
+                                  if c not in known_columns)
+            if column_headers:
+                writer = SchemaDictWriter(table_definition.full_path, column_headers, buffering=WRITER_BUFFER_SIZE)
+            else:
+                writer = ElasticDictWriter(table_definition.full_path, column_headers, buffering=WRITER_BUFFER_SIZE)
             self._writer_cache[table_name] = WriterCacheEntry(writer, table_definition)
 
         return self._writer_cache[table_name].writer
@@ -1,7 +1,11 @@
 import json
 import logging
-from typing import Tuple, List, Iterator
+import re
+import threading
+import time
+from typing import Tuple, List, Iterator, Optional, Dict
 
+import orjson
 import requests
 from keboola.http_client import HttpClient
 from requests import HTTPError
@@ -13,7 +17,20 @@ class ClientUserError(Exception):
     pass
 
 
+# only fieldData is extracted, related records of the layout portals are not requested
+NO_PORTALS = ()
+
+# numbers of 19+ digits may not fit into 64 bits, orjson would decode them as floats
+LONG_NUMBER_PATTERN = re.compile(rb'[:,\[]\s*-?\d{19}')
+
+
 class DataApiClient(HttpClient):
+    # connections kept alive in the pool, covers concurrent requests of the parallel downloads
+    POOL_MAXSIZE = 8
+    # FileMaker closes the session after 15 min of inactivity, cached sessions idle longer are not reused
+    SESSION_IDLE_TIMEOUT = 14 * 60
+    # FileMaker error code of a rejected session token
+    INVALID_TOKEN_ERROR_CODE = '952'
 
     def __init__(self,
                  server_url: str,
@@ -30,8 +47,15 @@ class DataApiClient(HttpClient):
         self._ssl_verify = ssl_verify
         self._current_session_token = None
         self._current_database = ''
+        # database => (session token, last use time)
+        self._session_tokens: Dict[str, Tuple[str, float]] = {}
+        self._database_locks: Dict[str, threading.Lock] = {}
+        self._database_locks_lock = threading.Lock()
+        self._closed = False
         super().__init__(base_url=base_url, max_retries=max_retries, backoff_factor=backoff_factor,
                          status_forcelist=status_forcelist)
+        # single keep-alive session reused by all requests
+        self._session = self._requests_retry_session()
 
     def login_to_database_session(self, database: str):
         """
@@ -47,7 +71,7 @@ class DataApiClient(HttpClient):
             response = self.post_raw(f'databases/{database}/sessions', json={}, auth=(self._user, self._password),
                                      verify=self._ssl_verify)
             response.raise_for_status()
-            token = response.json()['response']['token']
+            token = self._decode_response(response)['response']['token']
             return token
         except HTTPError as e:
             raise ClientUserError(
@@ -66,6 +90,105 @@ class DataApiClient(HttpClient):
         except Exception as e:
             logging.warning(f"Failed to logout from session. {e}")
 
+    def close(self):
+        """
+        Logs out from all database sessions opened by this client. No new sessions are opened afterwards,
+        e.g. by a page request of the prefetch thread that was still running.
+        Returns:
+
+        """
+        with self._database_locks_lock:
+            self._closed = True
+            database_locks = dict(self._database_locks)
+
+        for database, database_lock in database_locks.items():
+            with database_lock:
+                session_token, _ = self._session_tokens.pop(database, (None, 0.0))
+            if session_token:
+                self.logout_from_database_session(database, session_token)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_session_token(self, database: str, rejected_token: Optional[str] = None) -> str:
+        """
+        Returns token of the cached database session. Logs in if there is no session yet, if it was idle too long
+        or if its token was rejected by the server.
+        Args:
+            database: database name
+            rejected_token: token refused by the server, a new session is opened unless another thread already did
+
+        Returns: session token
+
+        """
+        # other databases may log in meanwhile
+        with self._get_database_lock(database):
+            if self._closed:
+                raise ClientUserError(f'Cannot open a session of database "{database}", the client is closed.')
+            session_token, last_used = self._session_tokens.get(database, (None, 0.0))
+            if (not session_token or session_token == rejected_token
+                    or time.monotonic() - last_used > self.SESSION_IDLE_TIMEOUT):
+                session_token = self.login_to_database_session(database)
+                self._session_tokens[database] = (session_token, time.monotonic())
+            return session_token
+
+    def _refresh_session_last_use(self, database: str, session_token: str):
+        """
+        Marks the cached session as used now. Skipped if the session was replaced or closed meanwhile,
+        so the token of a renewed session is not overwritten by the old one.
+        Args:
+            database: database name
+            session_token: token the request was performed with
+
+        Returns:
+
+        """
+        with self._get_database_lock(database):
+            cached_token, _ = self._session_tokens.get(database, (None, 0.0))
+            if cached_token == session_token:
+                self._session_tokens[database] = (session_token, time.monotonic())
+
+    def _get_database_lock(self, database: str) -> threading.Lock:
+        with self._database_locks_lock:
+            return self._database_locks.setdefault(database, threading.Lock())
+
+    def _session_request(self, database: str, method: str, endpoint: str, **kwargs) -> requests.Response:
+        """
+        Performs request in the cached database session, see close(). If the server rejects the session token,
+        e.g. the session was closed on the server side, logs in again and retries the request once.
+        Args:
+            database: database name
+            method: HTTP method
+            endpoint: endpoint path
+            **kwargs: request arguments
+
+        Returns:
+
+        """
+        session_token = self._get_session_token(database)
+        response = self._request_raw(method, endpoint, headers={"Authorization": f'Bearer {session_token}'},
+                                     verify=self._ssl_verify, **kwargs)
+        if self._is_invalid_token_response(response):
+            logging.info(f'The session of database "{database}" is no longer valid, logging in again.')
+            session_token = self._get_session_token(database, rejected_token=session_token)
+            response = self._request_raw(method, endpoint, headers={"Authorization": f'Bearer {session_token}'},
+                                         verify=self._ssl_verify, **kwargs)
+
+        self._refresh_session_last_use(database, session_token)
+        return response
+
+    def _is_invalid_token_response(self, response: requests.Response) -> bool:
+        if response.status_code != 401:
+            return False
+        try:
+            messages = orjson.loads(response.content).get('messages') or []
+        except ValueError:
+            return False
+        return any(str(message.get('code')) == self.INVALID_TOKEN_ERROR_CODE for message in messages)
+
     def find_records(self, database: str, layout: str,
                      query: List[dict], page_size=1000, sort: List[dict] = None) -> Iterator[Tuple[List[dict], dict]]:
         """
@@ -82,9 +205,7 @@ class DataApiClient(HttpClient):
 
         """
 
-        session_key = self.login_to_database_session(database)
-        auth_header = {"Authorization": f'Bearer {session_key}'}
-        json_data = {}
+        json_data = {"portal": NO_PORTALS}
         if query:
             json_data["query"] = query
 
@@ -95,23 +216,16 @@ class DataApiClient(HttpClient):
 
         has_more = True
         json_data['offset'] = 1
-        try:
-            while has_more:
-                json_data['limit'] = page_size
+        while has_more:
+            json_data['limit'] = page_size
 
-                response = self.post_raw(endpoint, json=json_data, verify=self._ssl_verify, headers=auth_header)
-                self._handle_http_error(response)
-                response_data = response.json().get('response', {})
+            response_data = self._get_data_page(database, 'POST', endpoint, json=json_data)
 
-                if response_data.get('data', []):
-                    has_more = True
-                    json_data['offset'] += page_size
-                else:
-                    has_more = False
+            json_data['offset'] += page_size
+            has_more = self._has_next_page(response_data['dataInfo'], len(response_data['data']),
+                                           json_data['offset'], page_size)
 
-                yield response_data['data'], response_data['dataInfo']
-        finally:
-            self.logout_from_database_session(database, session_key)
+            yield response_data['data'], response_data['dataInfo']
 
     def get_records(self, database: str, layout: str, page_size=1000,
                     sort: List[dict] = None) -> Iterator[Tuple[List[dict], dict]]:
@@ -126,30 +240,20 @@ class DataApiClient(HttpClient):
         Returns: Iterator of response data pages.
 
         """
-        session_key = self.login_to_database_session(database)
-        auth_header = {"Authorization": f'Bearer {session_key}'}
-
         endpoint = f'databases/{database}/layouts/{layout}/records'
         has_more = True
-        parameters = {"_offset": 1, "_limit": page_size}
+        parameters = {"_offset": 1, "_limit": page_size, "portal": json.dumps(NO_PORTALS)}
         if sort:
             parameters['_sort'] = json.dumps(sort)
-        try:
-            while has_more:
+        while has_more:
 
-                response = self.get_raw(endpoint, params=parameters, verify=self._ssl_verify, headers=auth_header)
-                self._handle_http_error(response)
-                response_data = response.json().get('response', {})
+            response_data = self._get_data_page(database, 'GET', endpoint, params=parameters)
 
-                if response_data['dataInfo']['returnedCount'] == page_size:
-                    has_more = True
-                    parameters['_offset'] += page_size
-                else:
-                    has_more = False
+            parameters['_offset'] += page_size
+            has_more = self._has_next_page(response_data['dataInfo'], len(response_data['data']),
+                                           parameters['_offset'], page_size)
 
-                yield response_data['data'], response_data['dataInfo']
-        finally:
-            self.logout_from_database_session(database, session_key)
+            yield response_data['data'], response_data['dataInfo']
 
     def get_database_names(self) -> List[str]:
         """
@@ -159,7 +263,7 @@ class DataApiClient(HttpClient):
         """
         response = self.get_raw('databases', auth=(self._user, self._password), verify=self._ssl_verify)
         self._handle_http_error(response)
-        response_data = response.json().get('response', {})
+        response_data = self._decode_response(response).get('response', {})
         return [record.get('name') for record in response_data['databases']]
 
     def get_product_information(self) -> dict:
@@ -172,7 +276,7 @@ class DataApiClient(HttpClient):
         url = self._build_url('productInfo', False)
         response = requests.get(url, auth=(self._user, self._password), verify=self._ssl_verify)
         self._handle_http_error(response)
-        response_data = response.json().get('response', {})
+        response_data = self._decode_response(response).get('response', {})
         return response_data
 
     def get_layouts(self, database: str) -> List[dict]:
@@ -184,16 +288,11 @@ class DataApiClient(HttpClient):
         Returns:
 
         """
-        session_key = self.login_to_database_session(database)
-        auth_header = {"Authorization": f'Bearer {session_key}'}
         endpoint = f'databases/{database}/layouts'
-        try:
-            response = self.get_raw(endpoint, headers=auth_header, verify=self._ssl_verify)
-            self._handle_http_error(response)
-            response_data = response.json().get('response', {})
-            return response_data.get('layouts', [])
-        finally:
-            self.logout_from_database_session(database, session_key)
+        response = self._session_request(database, 'GET', endpoint)
+        self._handle_http_error(response)
+        response_data = self._decode_response(response).get('response', {})
+        return response_data.get('layouts', [])
 
     def get_layout_field_metadata(self, database: str, layout: str) -> List[dict]:
         """
@@ -205,16 +304,67 @@ class DataApiClient(HttpClient):
         Returns:
 
         """
-        session_key = self.login_to_database_session(database)
-        auth_header = {"Authorization": f'Bearer {session_key}'}
         endpoint = f'databases/{database}/layouts/{layout}'
+        response = self._session_request(database, 'GET', endpoint)
+        self._handle_http_error(response)
+        response_data = self._decode_response(response).get('response', {})
+        return response_data.get('fieldMetaData', [])
+
+    @staticmethod
+    def _has_next_page(data_info: dict, returned_count: int, next_offset: int, page_size: int) -> bool:
+        """
+        Decides whether to request the next page, saves the request of an empty page at the end.
+        Args:
+            data_info: dataInfo of the last response
+            returned_count: number of records in the last page
+            next_offset: offset of the next page (1-based)
+            page_size:
+
+        Returns:
+
+        """
+        if returned_count < page_size:
+            return False
+        # full page, the next one exists unless all found records were already returned
+        return next_offset <= data_info.get('foundCount', next_offset)
+
+    def _get_data_page(self, database: str, method: str, endpoint: str, **kwargs) -> dict:
+        """
+        Requests a single page of records. Only the decoded data leaves this method, so the raw response body
+        is not kept alive by the suspended paging generator while the page is being processed.
+        Args:
+            database: database name
+            method: HTTP method
+            endpoint: endpoint path
+            **kwargs: request arguments
+
+        Returns: content of the `response` object
+
+        """
+        response = self._session_request(database, method, endpoint, **kwargs)
+        self._handle_http_error(response)
+        return self._decode_response(response).get('response', {})
+
+    @staticmethod
+    def _decode_response(response: requests.Response) -> dict:
+        """
+        Decodes JSON response body, invalid content is reported as a user error like the other response failures.
+        Bodies with numbers that may exceed 64 bits, e.g. Get(UUIDNumber) keys, are decoded by the standard json
+        module, which keeps them as exact integers.
+        Args:
+            response:
+
+        Returns: decoded body
+
+        """
+        content = response.content
         try:
-            response = self.get_raw(endpoint, headers=auth_header, verify=self._ssl_verify)
-            self._handle_http_error(response)
-            response_data = response.json().get('response', {})
-            return response_data.get('fieldMetaData', [])
-        finally:
-            self.logout_from_database_session(database, session_key)
+            if LONG_NUMBER_PATTERN.search(content):
+                return json.loads(content)
+            return orjson.loads(content)
+        except ValueError as e:
+            raise ClientUserError(f'Failed to decode the response from {response.url}. '
+                                  f'Detail: {e}, content: {response.text[:500]}') from e
 
     def _handle_http_error(self, response):
 
@@ -223,6 +373,21 @@ class DataApiClient(HttpClient):
         except requests.HTTPError as e:
             raise ClientUserError(f'Failed to perform find request. Detail: {e.response.text}')
 
+    # override to reuse the pooled session instead of opening a new connection for each request
+    def _request_raw(self, method: str, endpoint_path: Optional[str] = None, **kwargs) -> requests.Response:
+        is_absolute_path = kwargs.pop('is_absolute_path', False)
+        url = self._build_url(endpoint_path, is_absolute_path)
+
+        # request specific headers and auth, the shared session is never modified
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(self._default_header)
+        if not kwargs.pop('ignore_auth', False):
+            headers.update(self._auth_header)
+            if not kwargs.get('auth'):
+                kwargs['auth'] = self._auth
+
+        return self._session.request(method, url, headers=headers, **kwargs)
+
     # override to continue on failure
     def _requests_retry_session(self, session=None):
         session = session or requests.Session()
@@ -235,7 +400,7 @@ class DataApiClient(HttpClient):
             allowed_methods=self.allowed_methods,
             raise_on_status=False
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=self.POOL_MAXSIZE)
         session.mount('http://', adapter)
         session.mount('https://', adapter)
         return session
@@ -0,0 +1,141 @@
+import unittest
+
+import mock
+import requests
+
+from filemaker.client import DataApiClient, ClientUserError
+
+
+def build_response(content: bytes, status_code: int = 200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.url = 'https://fm.example.com/fmi/data/v2/databases/db/layouts/layout/_find'
+    return response
+
+
+class TestDataApiClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = DataApiClient('https://fm.example.com', 'user', 'password')
+
+    def test_invalid_json_body_raises_user_error(self):
+        with mock.patch.object(self.client, '_request_raw', return_value=build_response(b'<html>Bad Gateway')):
+            with self.assertRaises(ClientUserError):
+                self.client._get_data_page('db', 'POST', 'databases/db/layouts/layout/_find')
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', return_value='token')
+    def test_numbers_larger_than_64_bits_stay_exact(self, _):
+        page = build_response(b'{"response": {"data": [{"fieldData": {"id": 123456789012345678901234567890, '
+                              b'"neg": -9223372036854775809, "small": 42, "price": 1.5}}]}}')
+        with mock.patch.object(self.client, '_request_raw', return_value=page):
+            response_data = self.client._get_data_page('db', 'POST', 'databases/db/layouts/layout/_find')
+
+        self.assertEqual(response_data['data'][0]['fieldData'],
+                         {'id': 123456789012345678901234567890, 'neg': -9223372036854775809, 'small': 42, 'price': 1.5})
+        self.assertIsInstance(response_data['data'][0]['fieldData']['id'], int)
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', return_value='token')
+    def test_invalid_json_with_long_number_raises_user_error(self, _):
+        with mock.patch.object(self.client, '_request_raw', return_value=build_response(b'[12345678901234567890,')):
+            with self.assertRaises(ClientUserError):
+                self.client._get_data_page('db', 'POST', 'databases/db/layouts/layout/_find')
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', side_effect=['token1', 'token2', 'token3'])
+    def test_session_reused_per_database(self, login):
+        layouts = build_response(b'{"response": {"layouts": [{"name": "layout"}]}}')
+        with mock.patch.object(self.client, '_request_raw', return_value=layouts), \
+                mock.patch.object(self.client, 'logout_from_database_session') as logout:
+            self.client.get_layouts('db1')
+            self.client.get_layouts('db1')
+            self.client.get_layouts('db2')
+            self.client.close()
+
+        self.assertEqual(login.call_args_list, [mock.call('db1'), mock.call('db2')])
+        self.assertEqual(logout.call_args_list, [mock.call('db1', 'token1'), mock.call('db2', 'token2')])
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', side_effect=['token1', 'token2'])
+    def test_session_renewed_after_idle_timeout(self, login):
+        clock = [1000.0]
+        layouts = build_response(b'{"response": {"layouts": []}}')
+        with mock.patch('filemaker.client.time.monotonic', lambda: clock[0]), \
+                mock.patch.object(self.client, '_request_raw', return_value=layouts) as request:
+            self.client.get_layouts('db')
+            clock[0] += DataApiClient.SESSION_IDLE_TIMEOUT - 1
+            self.client.get_layouts('db')
+            self.assertEqual(login.call_count, 1)
+
+            clock[0] += DataApiClient.SESSION_IDLE_TIMEOUT + 1
+            self.client.get_layouts('db')
+
+        self.assertEqual(login.call_count, 2)
+        self.assertEqual(request.call_args.kwargs['headers'], {'Authorization': 'Bearer token2'})
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', side_effect=['token1', 'token2'])
+    def test_rejected_session_token_logs_in_again(self, login):
+        invalid_token = build_response(b'{"messages": [{"code": "952", "message": "Invalid FileMaker Data API token"}]}',
+                                       status_code=401)
+        layouts = build_response(b'{"response": {"layouts": [{"name": "layout"}]}}')
+        with mock.patch.object(self.client, '_request_raw', side_effect=[invalid_token, layouts]) as request:
+            self.assertEqual(self.client.get_layouts('db'), [{'name': 'layout'}])
+
+        self.assertEqual(login.call_count, 2)
+        self.assertEqual(request.call_args.kwargs['headers'], {'Authorization': 'Bearer token2'})
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', side_effect=['token1', 'token2'])
+    def test_stale_request_keeps_renewed_session(self, login):
+        layouts = build_response(b'{"response": {"layouts": []}}')
+
+        def renew_session_meanwhile(*args, **kwargs):
+            # another thread got the 952 error and logged in again while this request was running
+            self.client._get_session_token('db', rejected_token='token1')
+            return layouts
+
+        with mock.patch.object(self.client, '_request_raw', side_effect=renew_session_meanwhile), \
+                mock.patch.object(self.client, 'logout_from_database_session') as logout:
+            self.client.get_layouts('db')
+            self.client.close()
+
+        self.assertEqual(login.call_count, 2)
+        self.assertEqual(logout.call_args_list, [mock.call('db', 'token2')])
+
+    @mock.patch.object(DataApiClient, 'login_to_database_session', side_effect=['token1', 'token2'])
+    def test_request_finished_after_close_does_not_reopen_session(self, login):
+        layouts = build_response(b'{"response": {"layouts": []}}')
+
+        def close_meanwhile(*args, **kwargs):
+            # the component closed the client while the prefetch thread was waiting for the page
+            self.client.close()
+            return layouts
+
+        with mock.patch.object(self.client, '_request_raw', side_effect=close_meanwhile), \
+                mock.patch.object(self.client, 'logout_from_database_session') as logout:
+            self.client.get_layouts('db')
+            with self.assertRaises(ClientUserError):
+                self.client.get_layouts('db')
+
+        self.assertEqual(login.call_count, 1)
+        self.assertEqual(logout.call_args_list, [mock.call('db', 'token1')])
+        self.assertEqual(self.client._session_tokens, {})
+
+    def test_has_next_page_short_last_page(self):
+        data_info = {'foundCount': 25, 'returnedCount': 5}
+        self.assertFalse(DataApiClient._has_next_page(data_info, 5, 31, 10))
+
+    def test_has_next_page_exact_multiple_of_page_size(self):
+        data_info = {'foundCount': 20, 'returnedCount': 10}
+        self.assertTrue(DataApiClient._has_next_page(data_info, 10, 11, 10))
+        self.assertFalse(DataApiClient._has_next_page(data_info, 10, 21, 10))
+
+    def test_has_next_page_missing_found_count(self):
+        self.assertTrue(DataApiClient._has_next_page({'returnedCount': 10}, 10, 21, 10))
+        self.assertFalse(DataApiClient._has_next_page({'returnedCount': 3}, 3, 21, 10))
+
+    def test_has_next_page_missing_returned_count(self):
+        self.assertTrue(DataApiClient._has_next_page({'foundCount': 30}, 10, 11, 10))
+        self.assertTrue(DataApiClient._has_next_page({}, 10, 11, 10))
+        self.assertFalse(DataApiClient._has_next_page({}, 4, 11, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()
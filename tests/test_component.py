@@ -3,12 +3,17 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import csv
+import json
 import unittest
 import mock
 import os
+import tempfile
 from freezegun import freeze_time
+from keboola.csvwriter import ElasticDictWriter
+from keboola.component.exceptions import UserException
 
-from component import Component
+from component import Component, HeaderNormalizer, SchemaDictWriter, prefetch
 
 
 class TestComponent(unittest.TestCase):
@@ -22,6 +27,101 @@ class TestComponent(unittest.TestCase):
             comp = Component()
             comp.run()
 
+    def _build_component(self, tmp_dir: str, **parameters) -> Component:
+        parameters = {'base_url': 'https://fm.example.com', 'username': 'user', '#password': 'password',
+                      'database': 'db', **parameters}
+        with open(os.path.join(tmp_dir, 'config.json'), 'w') as config_file:
+            json.dump({'parameters': parameters}, config_file)
+        with mock.patch.dict(os.environ, {'KBC_DATADIR': tmp_dir}):
+            return Component()
+
+    def test_build_queries(self):
+        query = [[{'field_name': 'a', 'find_criteria': '1'}, {'field_name': 'b', 'find_criteria': '2'}],
+                 [{'field_name': 'a', 'find_criteria': '3'}]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            comp = self._build_component(tmp_dir, query=query)
+            self.assertEqual(comp._build_queries(), [{'a': '1', 'b': '2'}, {'a': '3'}])
+
+    def test_build_queries_duplicate_key_fails(self):
+        query = [[{'field_name': 'b', 'find_criteria': '0'}],
+                 [{'field_name': 'a', 'find_criteria': '>1'}, {'field_name': 'a', 'find_criteria': '<5'}]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            comp = self._build_component(tmp_dir, query=query)
+            with self.assertRaisesRegex(UserException, "Affected keys: {'a'}"):
+                comp._build_queries()
+
+    def test_header_normalization_roundtrip(self):
+        header = ['_id', 'name', '_hsh_note', 'col_hsh_x']
+        normalized = HeaderNormalizer.normalize_columns(header)
+        self.assertEqual(normalized, ['hsh_id', 'name', 'hsh_hsh_note', 'col_hsh_x'])
+        self.assertEqual(HeaderNormalizer.reconstruct_original_columns(normalized), header)
+
+    def test_prefetch_keeps_order_and_reraises(self):
+        def pages():
+            yield from range(5)
+            raise ValueError('failed page')
+
+        result = []
+        with self.assertRaises(ValueError):
+            for page in prefetch(pages()):
+                result.append(page)
+        self.assertEqual(result, list(range(5)))
+
+    def test_schema_writer_extends_header_on_new_column(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, 'result.csv')
+            writer = SchemaDictWriter(result_path, ['id', 'name'])
+            writer.writerows([{'id': 1, 'name': 'a'}, {'id': 2}, {'id': 3, 'name': 'c', 'note': 'x'}, {'id': 4}])
+            writer.writerow({'id': 5, 'name': 'e'})
+            writer.close()
+
+            self.assertEqual(writer.fieldnames, ['id', 'name', 'note'])
+            with open(result_path, 'rb') as result_file:
+                self.assertEqual(sorted(result_file.read().split(b'\n')), [b'', b'1,a,', b'2,,', b'3,c,x', b'4,,', b'5,e,'])
+
+    def test_schema_writer_line_terminator(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, 'result.csv')
+            writer = SchemaDictWriter(result_path, ['id', 'name'])
+            writer.writerows([{'id': 1, 'name': 'a'}, {'id': 2}])
+            writer.close()
+
+            with open(result_path, 'rb') as result_file:
+                self.assertEqual(result_file.read(), b'1,a\n2,\n')
+
+    def test_schema_writer_quotes_line_breaks_like_elastic_writer(self):
+        rows = [{'id': '1', 'note': 'line1\rline2'}, {'id': '2', 'note': 'a\r\nb'}, {'id': '3', 'note': 'x'}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, 'result.csv')
+            writer = SchemaDictWriter(result_path, ['id', 'note'])
+            writer.writerows(rows)
+            writer.close()
+
+            elastic_path = os.path.join(tmp_dir, 'elastic.csv')
+            elastic_writer = ElasticDictWriter(elastic_path, ['id', 'note'])
+            elastic_writer.writerows(rows)
+            elastic_writer.close()
+
+            with open(result_path, 'rb') as result_file, open(elastic_path, 'rb') as elastic_file:
+                result = result_file.read()
+                self.assertEqual(result, elastic_file.read())
+            self.assertEqual(result, b'1,"line1\nline2"\n2,"a\nb"\n3,x\n')
+
+    def test_schema_writer_fallback_keeps_special_values(self):
+        rows = [{'id': '1', 'name': 'line1\rline2'}, {'id': '2', 'name': 'say "hi", bye'},
+                {'id': '3', 'name': 'a\r\nb,c', 'note': 'new "x"\r'}, {'id': '4', 'name': ''}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = os.path.join(tmp_dir, 'result.csv')
+            writer = SchemaDictWriter(result_path, ['id', 'name'])
+            writer.writerows(rows)
+            writer.close()
+
+            self.assertEqual(writer.fieldnames, ['id', 'name', 'note'])
+            with open(result_path, 'r', newline='', encoding='utf-8') as result_file:
+                result = sorted(csv.reader(result_file))
+            self.assertEqual(result, [['1', 'line1\nline2', ''], ['2', 'say "hi", bye', ''],
+                                      ['3', 'a\nb,c', 'new "x"\n'], ['4', '', '']])
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']